@@ -1,13 +1,27 @@
 # app.py
+# patch before anything imports socket/ssl so requests and the Supabase
+# client yield to other greenlets while waiting on the network
+from gevent import monkey
+monkey.patch_all()
+
 import os
 import logging
-import secrets
+import hmac
+import hashlib
+import threading
+import time
 import re
 import csv
 import io
 import requests
 
-from flask import Flask, request, abort, jsonify, Response
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import (
+    Flask, request, abort, jsonify, Response, stream_with_context
+)
 from flask_cors import CORS
 from supabase import create_client
 from datetime import datetime, timezone
@@ -16,21 +30,68 @@ from datetime import datetime, timezone
 # Auth
 # ==================================================
 
+def _key_ok(header: str, key: bytes) -> bool:
+    # an unset key never matches, even against a missing header
+    return bool(key) and hmac.compare_digest(
+        (request.headers.get(header) or "").encode(), key
+    )
+
+def is_m() -> bool:
+    return _key_ok("X-M-Key", M_API_KEY)
+
+def is_c() -> bool:
+    return _key_ok("X-C-Key", C_API_KEY)
+
 def require_m():
-    if request.headers.get("X-M-Key") != os.environ.get("M_API_KEY"):
+    if not is_m():
         abort(403)
 
 def require_c():
-    if request.headers.get("X-C-Key") != os.environ.get("C_API_KEY"):
+    if not is_c():
         abort(403)
 
 def require_viewer():
-    if (
-        request.headers.get("X-M-Key") != os.environ.get("M_API_KEY")
-        and request.headers.get("X-C-Key") != os.environ.get("C_API_KEY")
-    ):
+    if not is_m() and not is_c():
         abort(403)
 
+def require_mailgun_signature():
+    # reject forged and replayed webhooks before any DB work
+    timestamp = request.form.get("timestamp", "")
+    token = request.form.get("token", "")
+    signature = request.form.get("signature", "")
+
+    try:
+        age = abs(time.time() - int(timestamp))
+    except ValueError:
+        abort(406)
+    if age > MAILGUN_MAX_AGE:
+        abort(406)
+
+    expected = hmac.new(
+        MAILGUN_SIGNING_KEY.encode(),
+        f"{timestamp}{token}".encode(),
+        hashlib.sha256,
+    ).hexdigest()
+    if not hmac.compare_digest(expected.encode(), signature.encode()):
+        abort(406)
+
+    with _seen_lock:
+        if token in _seen_tokens:
+            abort(406)
+
+    return token
+
+def remember_mailgun_token(token: str):
+    # only called once a delivery has been handled, so a failed attempt
+    # can still be retried by Mailgun
+    with _seen_lock:
+        if token in _seen_tokens:
+            return
+        if len(_seen_order) == _seen_order.maxlen:
+            _seen_tokens.discard(_seen_order[0])
+        _seen_order.append(token)
+        _seen_tokens.add(token)
+
 # ==================================================
 # App + DB
 # ==================================================
@@ -45,8 +106,19 @@ supabase = create_client(
     os.environ["SUPABASE_SERVICE_KEY"],
 )
 
+M_API_KEY = os.environ.get("M_API_KEY", "").encode()
+C_API_KEY = os.environ.get("C_API_KEY", "").encode()
+
 MAILGUN_DOMAIN = os.environ["MAILGUN_DOMAIN"]
 MAILGUN_API_KEY = os.environ["MAILGUN_API_KEY"]
+MAILGUN_SIGNING_KEY = os.environ["MAILGUN_SIGNING_KEY"]
+MAILGUN_MAX_AGE = 300  # seconds
+
+# recently seen webhook tokens, for replay rejection without a DB hit
+_seen_order = deque(maxlen=10_000)
+_seen_tokens = set()
+_seen_lock = threading.Lock()
+
 FROM_EMAIL = os.environ.get(
     "FROM_EMAIL", "Campaign <campaign@mg.renewableenergyx.com>"
 )
@@ -54,7 +126,44 @@ REPLY_TO = os.environ.get(
     "REPLY_TO", "reply@mg.renewableenergyx.com"
 )
 
+# Mailgun sends fan out over a thread pool; one shared session keeps
+# TLS connections alive across workers.
+SEND_WORKERS = int(os.environ.get("SEND_WORKERS", 32))
+
+# Only failures where Mailgun cannot have accepted the message are retried:
+# connect errors and 429/503. Read errors (timeouts/resets after the body
+# was sent) and 502/504 may follow an accepted send, so retrying them
+# would double-send.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=64,
+        max_retries=Retry(
+            total=3,
+            read=0,
+            backoff_factor=0.3,
+            status_forcelist=[429, 503],
+            allowed_methods=None,
+            raise_on_status=False,
+        ),
+    ),
+)
+
+# ids per `in.(...)` filter; keeps the PostgREST query string well under
+# URL length limits
+MARK_SENT_BATCH = 200
+
+# rows per page when exporting CSVs
+PAGE_SIZE = 1000
+
+# recipients per upsert request, and how many upserts run at once
+UPSERT_CHUNK = 500
+UPSERT_WORKERS = 4
+
 EMAIL_RE = re.compile(r"([A-Z0-9._%+\-]+@[A-Z0-9.\-]+\.[A-Z]{2,})", re.I)
+QUOTE_RE = re.compile(r"\n(?:On |From:|>)")
 
 # ==================================================
 # Helpers
@@ -63,20 +172,25 @@ EMAIL_RE = re.compile(r"([A-Z0-9._%+\-]+@[A-Z0-9.\-]+\.[A-Z]{2,})", re.I)
 def extract_email(s: str) -> str:
     if not s:
         return ""
+    s = s.strip()
+    # bare address (the usual Mailgun `sender`): one anchored match
+    if "<" not in s and " " not in s and EMAIL_RE.fullmatch(s):
+        return s.lower()
     m = EMAIL_RE.search(s)
     return m.group(1).lower() if m else ""
 
 def clean_body(text: str) -> str:
-    for marker in ("\nOn ", "\nFrom:", "\n>"):
-        if marker in text:
-            text = text.split(marker, 1)[0]
-    return text.strip()
+    # cut at the first quoted-reply marker, in one pass
+    m = QUOTE_RE.search(text)
+    return (text[:m.start()] if m else text).strip()
 
-def gen_token() -> str:
-    return secrets.token_hex(8)
+def gen_tokens(n: int) -> list:
+    # one urandom call for the whole batch instead of one per token
+    raw = os.urandom(8 * n)
+    return [raw[i:i + 8].hex() for i in range(0, 8 * n, 8)]
 
 def send_email(to_email: str, subject: str, body: str):
-    resp = requests.post(
+    resp = SESSION.post(
         f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages",
         auth=("api", MAILGUN_API_KEY),
         data={
@@ -86,20 +200,111 @@ def send_email(to_email: str, subject: str, body: str):
             "text": body,
             "h:Reply-To": REPLY_TO,
         },
-        timeout=20,
+        timeout=(3.05, 20),
     )
     resp.raise_for_status()
     return resp.json()
 
-def csv_response(filename: str, header: list, rows: list):
-    buf = io.StringIO()
-    writer = csv.writer(buf)
-    writer.writerow(header)
-    for r in rows:
-        writer.writerow(r)
+def mark_sent(ids: list, now: str):
+    # one UPDATE per batch of ids instead of one per recipient
+    for i in range(0, len(ids), MARK_SENT_BATCH):
+        supabase.table("campaign_recipients") \
+            .update({"sent_at": now}) \
+            .in_("id", ids[i:i + MARK_SENT_BATCH]) \
+            .execute()
+
+def send_batch(recipients: list, campaign: dict, now: str):
+    # send concurrently, marking sent_at as each MARK_SENT_BATCH fills;
+    # returns (sent, failed)
+    sent = 0
+    failed = 0
+    pending = []  # sent but not yet marked
+    futures = {}
+    handled = set()
+
+    pool = ThreadPoolExecutor(max_workers=SEND_WORKERS)
+    try:
+        futures = {
+            pool.submit(
+                send_email,
+                r["email"],
+                campaign["subject"],
+                campaign["body"],
+            ): r
+            for r in recipients
+        }
+        for fut in as_completed(futures):
+            handled.add(fut)
+            r = futures[fut]
+            try:
+                fut.result()
+            except Exception:
+                app.logger.exception(f"Failed to send to {r['email']}")
+                failed += 1
+                continue
+
+            sent += 1
+            pending.append(r["id"])
+            if len(pending) >= MARK_SENT_BATCH:
+                mark_sent(pending, now)
+                pending = []
+    finally:
+        # if marking failed, stop queued sends and still mark whatever
+        # went out, so a retried /send re-mails at most one batch
+        pool.shutdown(cancel_futures=True)
+        for fut, r in futures.items():
+            if (
+                fut not in handled
+                and not fut.cancelled()
+                and fut.exception() is None
+            ):
+                pending.append(r["id"])
+        if pending:
+            mark_sent(pending, now)
+
+    return sent, failed
+
+def iter_rows(table: str, cols: str, cid: str, order: str, desc=False):
+    # page through a campaign's rows so exports are not capped at the
+    # PostgREST max-rows limit; "id" breaks ties so pages never overlap.
+    # postgrest 0.10.x emits one `order=` param per .order() call, so the
+    # tie-break goes into a single value, and its .range() end is exclusive.
+    order_by = f"{order}{'.desc' if desc else ''},id"
+    off = 0
+    while True:
+        chunk = (
+            supabase.table(table)
+            .select(cols)
+            .eq("campaign_id", cid)
+            .order(order_by)
+            .range(off, off + PAGE_SIZE)
+            .execute()
+            .data
+        )
+        if not chunk:
+            break
+        yield from chunk
+        # the server may cap pages below PAGE_SIZE, so a short page is
+        # not the end; only an empty one is
+        off += len(chunk)
+
+def csv_response(filename: str, header: list, rows):
+    # rows may be any iterable; each row is written and flushed to the
+    # client as it is produced
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(header)
+        yield buf.getvalue()
+
+        for r in rows:
+            buf.seek(0)
+            buf.truncate()
+            writer.writerow(r)
+            yield buf.getvalue()
 
     return Response(
-        buf.getvalue(),
+        stream_with_context(generate()),
         mimetype="text/csv",
         headers={
             "Content-Disposition": f'attachment; filename="{filename}"'
@@ -118,6 +323,8 @@ def home():
 
 @app.route("/mailgun", methods=["POST"])
 def mailgun_webhook():
+    token = require_mailgun_signature()
+
     sender = extract_email(
         request.form.get("sender") or request.form.get("from") or ""
     )
@@ -128,42 +335,16 @@ def mailgun_webhook():
     if not sender or not body or not message_id:
         return "OK", 200
 
-    # dedupe
-    if (
-        supabase.table("replies")
-        .select("id")
-        .eq("message_id", message_id)
-        .execute()
-        .data
-    ):
-        return "OK", 200
-
-    rec = (
-        supabase.table("campaign_recipients")
-        .select("campaign_id, token")
-        .eq("email", sender)
-        .order("created_at", desc=True)
-        .limit(1)
-        .execute()
-        .data
-    )
-
-    if not rec:
-        return "OK", 200
-
-    supabase.table("replies").insert({
-        "campaign_id": rec[0]["campaign_id"],
-        "recipient_email": sender,
-        "token": rec[0]["token"],
-        "subject": subject,
-        "body": clean_body(body),
-        "message_id": message_id,
+    # dedupe, recipient lookup, insert and replied_at update all happen
+    # server-side (see migrations/)
+    supabase.rpc("ingest_reply", {
+        "p_sender": sender,
+        "p_subject": subject,
+        "p_body": clean_body(body),
+        "p_message_id": message_id,
     }).execute()
 
-    supabase.table("campaign_recipients").update({
-        "replied_at": "now()"
-    }).eq("email", sender).execute()
-
+    remember_mailgun_token(token)
     return "OK", 200
 
 # ------------------ Replies (JSON) ------------------
@@ -195,56 +376,22 @@ def list_replies():
 @app.route("/campaigns/<cid>/replies.csv", methods=["GET"])
 def replies_csv(cid):
     # viewer = M or C
-    is_m = request.headers.get("X-M-Key") == os.environ.get("M_API_KEY")
-    is_c = request.headers.get("X-C-Key") == os.environ.get("C_API_KEY")
-
-    if not is_m and not is_c:
+    m_view = is_m()
+    if not m_view and not is_c():
         abort(403)
 
-    rows = (
-        supabase.table("replies")
-        .select("received_at,recipient_email,token,subject,body")
-        .eq("campaign_id", cid)
-        .order("received_at", desc=True)
-        .execute()
-        .data
-        or []
-    )
+    # M-UI includes emails; C-UI never sees them (not even fetched)
+    if m_view:
+        cols = ("received_at", "recipient_email", "token", "subject", "body")
+    else:
+        cols = ("received_at", "token", "subject", "body")
 
-    # ---------------------------
-    # M-UI: include emails
-    # ---------------------------
-    if is_m:
-        return csv_response(
-            f"campaign_{cid}_replies.csv",
-            ["received_at", "recipient_email", "token", "subject", "body"],
-            [
-                [
-                    r["received_at"],
-                    r["recipient_email"],
-                    r["token"],
-                    r.get("subject", ""),
-                    r.get("body", ""),
-                ]
-                for r in rows
-            ],
-        )
+    rows = iter_rows("replies", ",".join(cols), cid, "received_at", desc=True)
 
-    # ---------------------------
-    # C-UI: NO EMAILS
-    # ---------------------------
     return csv_response(
         f"campaign_{cid}_replies.csv",
-        ["received_at", "token", "subject", "body"],
-        [
-            [
-                r["received_at"],
-                r["token"],
-                r.get("subject", ""),
-                r.get("body", ""),
-            ]
-            for r in rows
-        ],
+        list(cols),
+        (tuple(r.get(c, "") for c in cols) for r in rows),
     )
 
 
@@ -303,35 +450,44 @@ def upload_emails(cid):
     if not raw_emails:
         return jsonify({"error": "no emails provided"}), 400
 
-    # 🔴 THIS IS THE FIX (NORMALIZATION HAPPENS HERE)
+    # normalize, validate and dedupe in one pass
     cleaned = []
+    seen = set()
     invalid = 0
+    duplicates = 0
     for raw in raw_emails:
-        e = extract_email(str(raw))
+        e = extract_email(str(raw or ""))
         if not e:
             invalid += 1
-            continue
-        cleaned.append(e.lower())
-
-    cleaned = list(dict.fromkeys(cleaned))  # dedupe
+        elif e in seen:
+            duplicates += 1
+        else:
+            seen.add(e)
+            cleaned.append(e)
 
     if not cleaned:
         return jsonify({"error": "no valid emails found"}), 400
 
     rows = [
-        {"campaign_id": cid, "email": e, "token": gen_token()}
-        for e in cleaned
+        {"campaign_id": cid, "email": e, "token": t}
+        for e, t in zip(cleaned, gen_tokens(len(cleaned)))
     ]
 
-    supabase.table("campaign_recipients").upsert(
-        rows,
-        on_conflict="campaign_id,email",
-    ).execute()
+    def _upsert_chunk(i):
+        supabase.table("campaign_recipients").upsert(
+            rows[i:i + UPSERT_CHUNK],
+            on_conflict="campaign_id,email",
+            ignore_duplicates=True,
+        ).execute()
+
+    with ThreadPoolExecutor(max_workers=UPSERT_WORKERS) as pool:
+        list(pool.map(_upsert_chunk, range(0, len(rows), UPSERT_CHUNK)))
 
     return jsonify({
         "submitted": len(raw_emails),
         "valid": len(cleaned),
-        "invalid": invalid
+        "invalid": invalid,
+        "duplicates": duplicates,
     }), 200
 
 
@@ -355,44 +511,35 @@ def send_campaign(cid):
     if campaign["status"] != "ready":
         return jsonify({"error": "campaign not ready"}), 400
 
-    recipients = (
-        supabase.table("campaign_recipients")
-        .select("*")
-        .eq("campaign_id", cid)
-        .execute()
-        .data
-    )
-
-    # ✅ Filter unsent recipients in Python
-    recipients = [r for r in recipients if r["sent_at"] is None]
-
-
-    if not recipients:
-        return jsonify({"error": "no recipients uploaded"}), 400
-
     sent = 0
     failed = 0
-
     now = datetime.now(timezone.utc).isoformat()
-    for r in recipients:
-        try:
-            send_email(
-                r["email"],
-                campaign["subject"],
-                campaign["body"],
-            )
 
+    # keyset-page through unsent recipients by id: pages stay under the
+    # PostgREST max-rows cap, and rows that fail stay behind the cursor
+    # instead of being fetched again
+    last_id = None
+    while True:
+        q = (
+            supabase.table("campaign_recipients")
+            .select("id,email")
+            .eq("campaign_id", cid)
+            .is_("sent_at", "null")
+        )
+        if last_id is not None:
+            q = q.gt("id", last_id)
+        recipients = q.order("id").range(0, PAGE_SIZE).execute().data
 
-            supabase.table("campaign_recipients") \
-                .update({"sent_at": now}) \
-                .eq("id", r["id"]) \
-                .execute()
+        if not recipients:
+            break
 
+        page_sent, page_failed = send_batch(recipients, campaign, now)
+        sent += page_sent
+        failed += page_failed
+        last_id = recipients[-1]["id"]
 
-            sent += 1
-        except Exception as e:
-            app.logger.exception(f"Failed to send to {r['email']}")
-            failed += 1
+    if not sent and not failed:
+        return jsonify({"error": "no recipients uploaded"}), 400
 
     new_status = "sent" if failed == 0 else "partial"
 
@@ -417,20 +564,17 @@ def send_campaign(cid):
 def recipients_csv(cid):
     require_m()
 
-    rows = (
-        supabase.table("campaign_recipients")
-        .select("email,token,created_at,sent_at,replied_at")
-        .eq("campaign_id", cid)
-        .order("created_at")
-        .execute()
-        .data
-        or []
+    rows = iter_rows(
+        "campaign_recipients",
+        "email,token,created_at,sent_at,replied_at",
+        cid,
+        "created_at",
     )
 
     return csv_response(
         f"campaign_{cid}_email_token_map.csv",
         ["email", "token", "created_at", "sent_at", "replied_at"],
-        [
+        (
             [
                 r["email"],
                 r["token"],
@@ -439,7 +583,7 @@ def recipients_csv(cid):
                 r.get("replied_at"),
             ]
             for r in rows
-        ],
+        ),
     )
 
 # ------------------ Send campaign ------------------
@@ -505,6 +649,7 @@ def clear_all_data():
 # Main
 # ==================================================
 
+# local debugging only; production runs under gunicorn (gunicorn.conf.py)
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
     app.run(host="0.0.0.0", port=port)
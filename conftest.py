@@ -0,0 +1,17 @@
+# conftest.py
+# Root-level so pytest puts the repo root on sys.path and tests can
+# `import app` however pytest is invoked.
+import os
+
+from gevent import monkey
+
+# app.py calls monkey.patch_all() at import time, which is right for the
+# gunicorn worker but would come too late here (pytest has already imported
+# threading/ssl). Tests don't need cooperative I/O, so skip it.
+monkey.patch_all = lambda *args, **kwargs: None
+
+os.environ.setdefault("SUPABASE_URL", "https://example.supabase.co")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "header.payload.signature")
+os.environ.setdefault("MAILGUN_DOMAIN", "mg.example.com")
+os.environ.setdefault("MAILGUN_API_KEY", "key")
+os.environ.setdefault("MAILGUN_SIGNING_KEY", "signing-key")
@@ -0,0 +1,8 @@
+# gunicorn.conf.py
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gevent"
+worker_connections = 500
+timeout = 60
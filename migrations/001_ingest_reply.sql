@@ -0,0 +1,31 @@
+-- Ingest one inbound reply in a single round-trip: dedupe on message_id,
+-- attach it to the sender's most recent campaign, and stamp replied_at.
+create or replace function ingest_reply(
+    p_sender text,
+    p_subject text,
+    p_body text,
+    p_message_id text
+) returns void
+language plpgsql
+as $$
+begin
+    if exists (select 1 from replies where message_id = p_message_id) then
+        return;
+    end if;
+
+    insert into replies (
+        campaign_id, recipient_email, token, subject, body, message_id
+    )
+    select campaign_id, p_sender, token, p_subject, p_body, p_message_id
+    from campaign_recipients
+    where email = p_sender
+    order by created_at desc
+    limit 1;
+
+    if found then
+        update campaign_recipients
+        set replied_at = now()
+        where email = p_sender;
+    end if;
+end;
+$$;
@@ -0,0 +1,38 @@
+-- Enforce message_id uniqueness in the database so concurrent webhook
+-- deliveries of the same message cannot both insert.
+
+-- drop any duplicates left by the old SELECT-then-INSERT dedupe
+delete from replies a
+using replies b
+where a.message_id = b.message_id
+  and a.ctid > b.ctid;
+
+create unique index if not exists replies_message_id_key
+    on replies (message_id);
+
+create or replace function ingest_reply(
+    p_sender text,
+    p_subject text,
+    p_body text,
+    p_message_id text
+) returns void
+language plpgsql
+as $$
+begin
+    insert into replies (
+        campaign_id, recipient_email, token, subject, body, message_id
+    )
+    select campaign_id, p_sender, token, p_subject, p_body, p_message_id
+    from campaign_recipients
+    where email = p_sender
+    order by created_at desc
+    limit 1
+    on conflict (message_id) do nothing;
+
+    if found then
+        update campaign_recipients
+        set replied_at = now()
+        where email = p_sender;
+    end if;
+end;
+$$;
@@ -0,0 +1,90 @@
+import app
+
+
+class FakeQuery:
+    # mimics postgrest 0.10.x: one `order` value, exclusive `range` end,
+    # and a server-side max-rows cap
+    def __init__(self, rows, max_rows):
+        self.rows = rows
+        self.max_rows = max_rows
+        self.orders = []
+        self.start = 0
+        self.stop = None
+        self.data = None
+
+    def select(self, cols):
+        return self
+
+    def eq(self, col, val):
+        self.rows = [r for r in self.rows if r[col] == val]
+        return self
+
+    def order(self, column, desc=False):
+        self.orders.append(column + (".desc" if desc else ""))
+        return self
+
+    def range(self, start, end):
+        self.start, self.stop = start, end
+        return self
+
+    def execute(self):
+        assert len(self.orders) == 1
+        for spec in reversed(self.orders[0].split(",")):
+            col, _, direction = spec.partition(".")
+            self.rows = sorted(
+                self.rows, key=lambda r: r[col], reverse=direction == "desc"
+            )
+        stop = min(self.stop, self.start + self.max_rows)
+        self.data = self.rows[self.start:stop]
+        return self
+
+
+class FakeSupabase:
+    def __init__(self, rows, max_rows=1000):
+        self.rows = rows
+        self.max_rows = max_rows
+        self.requests = 0
+
+    def table(self, name):
+        self.requests += 1
+        return FakeQuery(list(self.rows), self.max_rows)
+
+
+def test_iter_rows_pages_past_page_size(monkeypatch):
+    # many ties on the sort key, so paging relies on the id tie-break
+    rows = [
+        {"id": i, "campaign_id": "c1", "received_at": i // 7}
+        for i in range(2500)
+    ]
+    fake = FakeSupabase(rows)
+    monkeypatch.setattr(app, "supabase", fake)
+
+    got = list(app.iter_rows("replies", "*", "c1", "received_at", desc=True))
+
+    assert len(got) == 2500
+    assert len({r["id"] for r in got}) == 2500
+    assert fake.requests == 4
+
+
+def test_iter_rows_exact_multiple_of_page_size(monkeypatch):
+    rows = [
+        {"id": i, "campaign_id": "c1", "created_at": i}
+        for i in range(app.PAGE_SIZE * 2)
+    ]
+    monkeypatch.setattr(app, "supabase", FakeSupabase(rows))
+
+    got = list(app.iter_rows("campaign_recipients", "*", "c1", "created_at"))
+
+    assert [r["id"] for r in got] == list(range(app.PAGE_SIZE * 2))
+
+
+def test_iter_rows_server_max_rows_below_page_size(monkeypatch):
+    rows = [
+        {"id": i, "campaign_id": "c1", "created_at": i}
+        for i in range(1234)
+    ]
+    monkeypatch.setattr(app, "supabase", FakeSupabase(rows, max_rows=300))
+
+    got = list(app.iter_rows("campaign_recipients", "*", "c1", "created_at"))
+
+    assert [r["id"] for r in got] == list(range(1234))
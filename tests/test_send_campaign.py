@@ -0,0 +1,144 @@
+import app
+
+
+class FakeQuery:
+    # just enough of postgrest 0.10.x for send_campaign: filters, one
+    # `order` value, exclusive `range` end, a max-rows cap, and updates
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.filters = []
+        self.orders = []
+        self.start = 0
+        self.stop = None
+        self.values = None
+        self.one = False
+
+    def select(self, cols):
+        return self
+
+    def update(self, values):
+        self.values = values
+        return self
+
+    def eq(self, col, val):
+        self.filters.append(lambda r: r[col] == val)
+        return self
+
+    def is_(self, col, val):
+        assert val == "null"
+        self.filters.append(lambda r: r[col] is None)
+        return self
+
+    def gt(self, col, val):
+        self.filters.append(lambda r: r[col] > val)
+        return self
+
+    def in_(self, col, vals):
+        vals = set(vals)
+        self.filters.append(lambda r: r[col] in vals)
+        return self
+
+    def order(self, column, desc=False):
+        self.orders.append(column)
+        return self
+
+    def range(self, start, end):
+        self.start, self.stop = start, end
+        return self
+
+    def single(self):
+        self.one = True
+        return self
+
+    def execute(self):
+        rows = [
+            r for r in self.db.tables[self.table]
+            if all(f(r) for f in self.filters)
+        ]
+        if self.values is not None:
+            if self.table == "campaign_recipients":
+                self.db.marks.append(len(rows))
+            for r in rows:
+                r.update(self.values)
+            self.data = rows
+            return self
+
+        assert len(self.orders) <= 1
+        if self.orders:
+            rows = sorted(rows, key=lambda r: r[self.orders[0]])
+        stop = self.start + self.db.max_rows
+        if self.stop is not None:
+            stop = min(stop, self.stop)
+        rows = [dict(r) for r in rows[self.start:stop]]
+        self.data = rows[0] if self.one else rows
+        return self
+
+
+class FakeSupabase:
+    def __init__(self, tables, max_rows):
+        self.tables = tables
+        self.max_rows = max_rows
+        self.marks = []
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+
+def make_db(n, max_rows):
+    return FakeSupabase(
+        {
+            "campaigns": [
+                {"id": "c1", "status": "ready", "subject": "s", "body": "b"},
+            ],
+            "campaign_recipients": [
+                {
+                    "id": f"{i:05d}",
+                    "campaign_id": "c1",
+                    "email": f"user{i}@example.com",
+                    "sent_at": None,
+                }
+                for i in range(n)
+            ],
+        },
+        max_rows,
+    )
+
+
+def post_send(monkeypatch, db, send_email):
+    monkeypatch.setattr(app, "supabase", db)
+    monkeypatch.setattr(app, "send_email", send_email)
+    monkeypatch.setattr(app, "M_API_KEY", b"m-key")
+    client = app.app.test_client()
+    return client.post("/campaigns/c1/send", headers={"X-M-Key": "m-key"})
+
+
+def test_send_campaign_pages_past_server_max_rows(monkeypatch):
+    db = make_db(1500, max_rows=400)
+    sent_to = []
+
+    resp = post_send(monkeypatch, db, lambda to, s, b: sent_to.append(to))
+
+    assert resp.status_code == 200
+    assert resp.get_json() == {"sent": 1500, "failed": 0}
+    assert len(set(sent_to)) == 1500
+    assert all(r["sent_at"] for r in db.tables["campaign_recipients"])
+    assert db.tables["campaigns"][0]["status"] == "sent"
+    assert max(db.marks) <= app.MARK_SENT_BATCH
+
+
+def test_send_campaign_failures_are_not_refetched(monkeypatch):
+    db = make_db(1200, max_rows=1000)
+    attempts = []
+
+    def send_email(to, subject, body):
+        attempts.append(to)
+        if to.endswith("7@example.com"):
+            raise RuntimeError("mailgun down")
+
+    resp = post_send(monkeypatch, db, send_email)
+
+    assert resp.status_code == 200
+    assert resp.get_json() == {"sent": 1080, "failed": 120}
+    assert len(attempts) == 1200
+    assert db.tables["campaigns"][0]["status"] == "partial"